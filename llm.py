@@ -0,0 +1,458 @@
+import asyncio
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import cachetools
+import httpx
+import diskcache
+import numpy as np
+import streamlit as st
+import openai
+import anthropic
+import tiktoken
+import tenacity
+from aiolimiter import AsyncLimiter
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Set CLAUDE_MODEL to pin a snapshot or to move on when the default model is retired
+CLAUDE_MODEL = os.getenv("CLAUDE_MODEL", "claude-sonnet-4-5")
+
+# OpenAI models offered in the sidebar
+OPENAI_MODELS = ("gpt-4o-mini", "gpt-4o", "gpt-4", "gpt-3.5-turbo")
+
+# (context window, output limit) in tokens, used to size requests and document windows.
+# The Claude entry is conservative enough for any current Claude model set through CLAUDE_MODEL.
+MODEL_LIMITS = {
+    "gpt-4o-mini": (128000, 16384),
+    "gpt-4o": (128000, 16384),
+    "gpt-4": (8192, 4096),
+    "gpt-3.5-turbo": (16385, 4096),
+    CLAUDE_MODEL: (200000, 8192),
+}
+
+# Initialize API keys
+def get_openai_api_key():
+    if 'openai' in st.secrets:
+        return st.secrets['openai']['api_key']
+    api_key = os.getenv('OPENAI_API_KEY')
+    if api_key is None:
+        raise ValueError("OpenAI API key not found. Set OPENAI_API_KEY as an environment variable or in Streamlit secrets.")
+    return api_key
+
+def get_anthropic_api_key():
+    if 'anthropic' in st.secrets:
+        return st.secrets['anthropic']['api_key']
+    api_key = os.getenv('ANTHROPIC_API_KEY')
+    if api_key is None:
+        raise ValueError("Anthropic API key not found. Set ANTHROPIC_API_KEY as an environment variable or in Streamlit secrets.")
+    return api_key
+
+# Keep-alive pool sized above MAX_CONCURRENCY, so concurrent calls reuse warm (HTTP/2 multiplexed)
+# connections instead of paying a TCP+TLS handshake per request
+HTTP_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32)
+HTTP_TIMEOUT = httpx.Timeout(120.0, connect=5.0)
+
+def _http_client():
+    return httpx.Client(http2=True, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+
+# Set up clients once per process and share them (and their connection pools) across reruns and pages
+@st.cache_resource
+def get_openai_client():
+    return openai.OpenAI(api_key=get_openai_api_key(), http_client=_http_client())
+
+@st.cache_resource
+def get_anthropic_client():
+    return anthropic.Anthropic(api_key=get_anthropic_api_key(), http_client=_http_client())
+
+# cl100k_base is the GPT-3.5 tokenizer; gpt-4o's o200k_base needs slightly fewer tokens for the same text
+# and for Claude it is a close enough estimate, so budgets computed with it stay on the safe side
+@st.cache_resource
+def get_encoding():
+    return tiktoken.get_encoding("cl100k_base")
+
+# Each page has its own default model; OPENAI_MODEL overrides it on every page
+def default_openai_model(page_default):
+    return os.getenv("OPENAI_MODEL", page_default)
+
+# Models without an entry (e.g. set through OPENAI_MODEL) get gpt-3.5-turbo's conservative limits
+def model_limits(model):
+    return MODEL_LIMITS.get(model, MODEL_LIMITS["gpt-3.5-turbo"])
+
+def is_claude(model):
+    return model.startswith("claude")
+
+# Errors caused by the request itself (e.g. context length exceeded), which retrying cannot fix
+BAD_REQUEST_ERRORS = (openai.BadRequestError, anthropic.BadRequestError)
+
+RESPONSE_CACHE_TTL = 3600
+RESPONSE_CACHE_MAX_ENTRIES = 256
+
+class _MemoryCache:
+    def __init__(self):
+        self._cache = cachetools.TTLCache(maxsize=RESPONSE_CACHE_MAX_ENTRIES, ttl=RESPONSE_CACHE_TTL)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._cache.get(key)
+
+    def set(self, key, value, expire=None):
+        with self._lock:
+            self._cache[key] = value
+
+# Completed responses keyed on (model, prompt, parameters); shared across sessions and pages.
+# Set LLM_CACHE_DIR to keep them on disk across restarts and server processes.
+@st.cache_resource
+def _response_cache():
+    cache_dir = os.getenv("LLM_CACHE_DIR")
+    if cache_dir:
+        return diskcache.Cache(cache_dir)
+    return _MemoryCache()
+
+# Sampled (temperature > 0) responses are not reproducible, so they are never served from the cache
+def _cache_key(key_parts, params):
+    if params["temperature"] > 0:
+        return None
+    return hashlib.sha256(repr(key_parts).encode("utf-8")).hexdigest()
+
+def _cached_stream(key, open_stream):
+    if key is None:
+        yield from open_stream()
+        return
+
+    cache = _response_cache()
+    cached = cache.get(key)
+    if cached is not None:
+        yield cached
+        return
+
+    parts = []
+    for text in open_stream():
+        parts.append(text)
+        yield text
+    # Only fully received responses are cached; an interrupted stream never gets here
+    cache.set(key, "".join(parts), expire=RESPONSE_CACHE_TTL)
+
+# Transient rate-limit, connection, timeout and server (5xx) errors are retried with randomized exponential backoff
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.InternalServerError,
+    anthropic.RateLimitError,
+    anthropic.APIConnectionError,
+    anthropic.APITimeoutError,
+    anthropic.InternalServerError,
+)
+
+_retry = tenacity.retry(
+    wait=tenacity.wait_random_exponential(min=1, max=30),
+    stop=tenacity.stop_after_attempt(5),
+    retry=tenacity.retry_if_exception_type(RETRYABLE_ERRORS),
+    before_sleep=tenacity.before_sleep_log(logger, logging.WARNING),
+    reraise=True,
+)
+
+# Requests are routed by prompt_cache_key, so ones sharing the same instructions (the static prefix)
+# land on the same backend and hit OpenAI's prompt cache, whichever session sent them
+def chat_request(system, prompt, model, max_tokens, params, response_format=None):
+    request = {
+        "model": model,
+        "prompt_cache_key": hashlib.sha256(system.encode("utf-8")).hexdigest()[:32],
+        "messages": [
+            {"role": "system", "content": system},
+            {"role": "user", "content": prompt}
+        ],
+        "max_tokens": max_tokens,
+        "temperature": params["temperature"],
+        "top_p": params["top_p"],
+        "frequency_penalty": params["frequency_penalty"],
+        "presence_penalty": params["presence_penalty"]
+    }
+    if response_format is not None:
+        request["response_format"] = response_format
+    return request
+
+# The request is sent when the stream is opened, so that is the call that gets retried
+@_retry
+def _open_openai_stream(system, prompt, model, max_tokens, params, response_format):
+    return get_openai_client().chat.completions.create(
+        **chat_request(system, prompt, model, max_tokens, params, response_format),
+        stream=True
+    )
+
+# Claude API doesn't use frequency_penalty and presence_penalty
+def anthropic_request(system, prompt, model, max_tokens, params, tool=None):
+    request = {
+        "model": model,
+        "max_tokens": max_tokens,
+        "system": system,
+        "messages": [{"role": "user", "content": prompt}],
+        "temperature": params["temperature"],
+        "top_p": params["top_p"],
+    }
+    if tool is not None:
+        request["tools"] = [tool]
+        request["tool_choice"] = {"type": "tool", "name": tool["name"]}
+    return request
+
+@_retry
+def _open_anthropic_stream(system, prompt, model, max_tokens, params, tool):
+    return get_anthropic_client().messages.create(
+        **anthropic_request(system, prompt, model, max_tokens, params, tool),
+        stream=True
+    )
+
+def _stream_openai(system, prompt, model, max_tokens, params, response_format):
+    for chunk in _open_openai_stream(system, prompt, model, max_tokens, params, response_format):
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+# A forced tool call streams its input as JSON fragments instead of text
+def _stream_anthropic(system, prompt, model, max_tokens, params, tool):
+    for event in _open_anthropic_stream(system, prompt, model, max_tokens, params, tool):
+        if event.type == "content_block_delta":
+            if event.delta.type == "text_delta":
+                yield event.delta.text
+            elif event.delta.type == "input_json_delta":
+                yield event.delta.partial_json
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_MAX_TOKENS = 8000
+
+# text-embedding-3-small uses the same cl100k_base tokenizer, so the prompt is sent as tokens
+@_retry
+def embed(tokens):
+    response = get_openai_client().embeddings.create(model=EMBEDDING_MODEL, input=[tokens])
+    vector = np.asarray(response.data[0].embedding, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+# Earlier responses looked up by cosine similarity of their prompt embeddings. Entries are
+# persisted in SQLite and searched in memory; a flat scan is plenty for a few thousand threads.
+class _SemanticCache:
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS responses (namespace TEXT NOT NULL, embedding BLOB NOT NULL, response TEXT NOT NULL)")
+        self._db.commit()
+        self._entries = {}
+        for namespace, embedding, response in self._db.execute("SELECT namespace, embedding, response FROM responses"):
+            self._remember(namespace, np.frombuffer(embedding, dtype=np.float32), response)
+
+    def _remember(self, namespace, embedding, response):
+        vectors, responses = self._entries.setdefault(namespace, ([], []))
+        vectors.append(embedding)
+        responses.append(response)
+
+    def lookup(self, namespace, embedding, threshold):
+        with self._lock:
+            vectors, responses = self._entries.get(namespace, ([], []))
+            if not vectors:
+                return None
+            similarities = np.stack(vectors) @ embedding
+            best = int(np.argmax(similarities))
+            return responses[best] if similarities[best] >= threshold else None
+
+    def add(self, namespace, embedding, response):
+        with self._lock:
+            self._db.execute("INSERT INTO responses VALUES (?, ?, ?)", (namespace, embedding.tobytes(), response))
+            self._db.commit()
+            self._remember(namespace, embedding, response)
+
+@st.cache_resource
+def _semantic_cache():
+    return _SemanticCache(os.getenv("SEMANTIC_CACHE_PATH", ".semantic_cache.sqlite3"))
+
+def _with_semantic_cache(namespace, prompt, threshold, open_stream):
+    def open_semantic_stream():
+        tokens = get_encoding().encode(prompt)
+        # A truncated embedding would only compare the beginnings of longer prompts
+        if len(tokens) > EMBEDDING_MAX_TOKENS:
+            yield from open_stream()
+            return
+
+        embedding = embed(tokens)
+        cache = _semantic_cache()
+        cached = cache.lookup(namespace, embedding, threshold)
+        if cached is not None:
+            yield cached
+            return
+
+        parts = []
+        for text in open_stream():
+            parts.append(text)
+            yield text
+        cache.add(namespace, embedding, "".join(parts))
+    return open_semantic_stream
+
+# response_format (OpenAI JSON mode) is only sent to OpenAI models; tool (a Claude tool definition) is only
+# sent to Claude, which is then forced to answer through it, so the response is the tool input as JSON.
+# With semantic=True, params["semantic_threshold"] (when set) also serves answers to near-identical prompts from
+# the semantic cache. Only per-thread analyses opt in: a near match must never stand in for a different document.
+def stream_completion(system, prompt, model, max_tokens, params, response_format=None, tool=None, semantic=False):
+    threshold = params.get("semantic_threshold")
+    params = {name: value for name, value in params.items() if name != "semantic_threshold"}
+    key = _cache_key((model, system, prompt, max_tokens, sorted(params.items()), response_format, tool), params)
+    if is_claude(model):
+        open_stream = lambda: _stream_anthropic(system, prompt, model, max_tokens, params, tool)
+    else:
+        open_stream = lambda: _stream_openai(system, prompt, model, max_tokens, params, response_format)
+
+    # Only answers produced for the same model and instructions are candidates
+    if semantic and threshold is not None:
+        namespace = hashlib.sha256(repr((model, system, max_tokens, response_format, tool)).encode("utf-8")).hexdigest()
+        open_stream = _with_semantic_cache(namespace, prompt, threshold, open_stream)
+    return _cached_stream(key, open_stream)
+
+def complete(system, prompt, model, max_tokens, params, response_format=None, tool=None):
+    return "".join(stream_completion(system, prompt, model, max_tokens, params, response_format, tool))
+
+# Upper bound on in-flight API requests; the per-minute request and token budgets default to
+# OpenAI's tier-1 limits and can be raised from the sidebar (see ui.render_inputs)
+MAX_CONCURRENCY = 10
+REQUESTS_PER_MINUTE = 500
+TOKENS_PER_MINUTE = 90000
+
+# Client-side token buckets, so bursts of concurrent calls stay under the provider's RPM/TPM
+# limits instead of tripping 429s and backing off. Created on the script thread, which owns the session state.
+class _Throttle:
+    def __init__(self, max_tokens):
+        self._max_tokens = max_tokens
+        self._tokens_per_minute = st.session_state.get("tokens_per_minute", TOKENS_PER_MINUTE)
+        self._requests = AsyncLimiter(st.session_state.get("requests_per_minute", REQUESTS_PER_MINUTE), 60)
+        self._tokens = AsyncLimiter(self._tokens_per_minute, 60)
+        self._semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+
+    # Items are prompts, or lists of texts sent together; the output budget is reserved up front
+    def _estimated_tokens(self, item):
+        text = item if isinstance(item, str) else "\n".join(item)
+        return min(len(get_encoding().encode(text)) + self._max_tokens, self._tokens_per_minute)
+
+    @contextlib.asynccontextmanager
+    async def slot(self, item):
+        async with self._semaphore, self._requests:
+            await self._tokens.acquire(self._estimated_tokens(item))
+            yield
+
+async def _gather_in_threads(func, items, args, throttle, on_result):
+    async def run(index, item):
+        async with throttle.slot(item):
+            # Run the blocking call in a worker thread; the HTTP wait releases the GIL
+            return index, await asyncio.to_thread(func, item, *args)
+
+    results = [None] * len(items)
+    # Handle results in completion order so callers can show each one as soon as it is ready
+    for next_done in asyncio.as_completed([run(index, item) for index, item in enumerate(items)]):
+        index, result = await next_done
+        results[index] = result
+        if on_result is not None:
+            on_result(index, result)
+    return results
+
+# Calls func(item, *args) for every item concurrently and returns the results in item order.
+# max_tokens is the output budget of each call, counted towards the tokens-per-minute limit.
+# on_result(index, result), if given, is called on the script thread as each call finishes.
+def run_concurrently(func, items, *args, max_tokens, on_result=None):
+    return asyncio.run(_gather_in_threads(func, items, args, _Throttle(max_tokens), on_result))
+
+async def _stream_in_threads(func, items, args, throttle, on_text):
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+
+    def drain(index, item):
+        for text in func(item, *args):
+            loop.call_soon_threadsafe(queue.put_nowait, (index, text))
+
+    async def run(index, item):
+        async with throttle.slot(item):
+            await asyncio.to_thread(drain, index, item)
+
+    workers = asyncio.gather(*(run(index, item) for index, item in enumerate(items)))
+    # Queued after every chunk the workers have already handed over, so nothing is lost
+    workers.add_done_callback(lambda _: queue.put_nowait(None))
+
+    texts = [""] * len(items)
+    while (entry := await queue.get()) is not None:
+        index, text = entry
+        texts[index] += text
+        on_text(index, texts[index])
+    await workers
+    return texts
+
+# Like run_concurrently, but func(item, *args) yields text chunks; on_text(index, text_so_far)
+# is called on the script thread after every chunk, so all streams can be rendered live.
+def stream_concurrently(func, items, *args, max_tokens, on_text):
+    return asyncio.run(_stream_in_threads(func, items, args, _Throttle(max_tokens), on_text))
+
+# Overlapping token windows, so no part of a long text is dropped
+def chunk_text(text, chunk_tokens=2500, overlap=200):
+    encoding = get_encoding()
+    tokens = encoding.encode(text)
+    step = chunk_tokens - overlap
+    return [encoding.decode(tokens[start:start + chunk_tokens]) for start in range(0, max(len(tokens) - overlap, 1), step)]
+
+OPENAI_BATCH_FAILED_STATUSES = ("failed", "expired", "cancelled")
+
+# Batch requests are billed at half price but complete asynchronously (within 24h), so they are
+# submitted here and collected later with fetch_batch. Returns the batch id.
+def submit_batch(system, prompts, model, max_tokens, params):
+    if is_claude(model):
+        batch = get_anthropic_client().messages.batches.create(requests=[
+            {"custom_id": f"request-{i}", "params": anthropic_request(system, prompt, model, max_tokens, params)}
+            for i, prompt in enumerate(prompts)
+        ])
+        return batch.id
+
+    client = get_openai_client()
+    lines = [
+        json.dumps({
+            "custom_id": f"request-{i}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": chat_request(system, prompt, model, max_tokens, params)
+        })
+        for i, prompt in enumerate(prompts)
+    ]
+    batch_file = client.files.create(file=("requests.jsonl", "\n".join(lines).encode("utf-8")), purpose="batch")
+    batch = client.batches.create(input_file_id=batch_file.id, endpoint="/v1/chat/completions", completion_window="24h")
+    return batch.id
+
+# Returns (finished, results, status). Once the batch has finished, results holds one response per
+# request (None where that request failed), or is None if the batch itself failed.
+def fetch_batch(batch_id, model, count):
+    results = {}
+    if is_claude(model):
+        client = get_anthropic_client()
+        batch = client.messages.batches.retrieve(batch_id)
+        if batch.processing_status != "ended":
+            counts = batch.request_counts
+            done = counts.succeeded + counts.errored + counts.canceled + counts.expired
+            return False, None, f"Batch {batch.processing_status}: {done}/{count} requests"
+        for entry in client.messages.batches.results(batch_id):
+            if entry.result.type == "succeeded":
+                results[entry.custom_id] = "".join(block.text for block in entry.result.message.content if block.type == "text")
+    else:
+        client = get_openai_client()
+        batch = client.batches.retrieve(batch_id)
+        if batch.status in OPENAI_BATCH_FAILED_STATUSES:
+            return True, None, f"Batch {batch_id} ended with status '{batch.status}'."
+        if batch.status != "completed":
+            counts = batch.request_counts
+            done = counts.completed + counts.failed if counts else 0
+            return False, None, f"Batch {batch.status}: {done}/{count} requests"
+        if batch.output_file_id is not None:
+            for line in client.files.content(batch.output_file_id).text.splitlines():
+                item = json.loads(line)
+                response = item.get("response")
+                if response and response["status_code"] == 200:
+                    results[item["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+    return True, [results.get(f"request-{i}") for i in range(count)], "completed"
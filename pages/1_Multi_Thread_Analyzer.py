@@ -0,0 +1,506 @@
+import hashlib
+import json
+from string import Template
+import streamlit as st
+from llm import BAD_REQUEST_ERRORS, model_limits, stream_completion, complete, run_concurrently, stream_concurrently, chunk_text, get_encoding, submit_batch, fetch_batch
+from ui import render_inputs, analysis_key
+
+OPENAI_MODEL = "gpt-4o-mini"
+MAX_TOKENS = 2000
+
+SEPARATION_INSTRUCTIONS = """
+    The following content contains multiple email threads related to machinery defects, incidents, or troubles. 
+    Please separate these threads. Each thread should be returned complete, exactly as it appears in the content.
+    Use your intelligence to identify where one thread ends and another begins.
+    Respond only with a JSON object of the form {"threads": ["<full text of thread 1>", "<full text of thread 2>", ...]}.
+    """
+
+# Claude has no JSON mode; forcing it to call this tool gets the same {"threads": [...]} object
+SEPARATION_TOOL = {
+    "name": "emit_threads",
+    "description": "Emit the separated email threads, each complete and exactly as it appears in the content.",
+    "input_schema": {
+        "type": "object",
+        "properties": {"threads": {"type": "array", "items": {"type": "string"}}},
+        "required": ["threads"],
+    },
+}
+
+# Claude has no JSON mode either for grouped analyses, and a free-form reply would send the whole group back one thread per request
+GROUPED_TOOL = {
+    "name": "emit_analyses",
+    "description": "Emit the FMEA analysis of each email thread, in the order the threads were given.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "threads": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {name: {"type": "string"} for name in ("failure_mode", "failure_symptom", "failure_effect", "failure_cause", "case_study")},
+                    "required": ["failure_mode", "failure_symptom", "failure_effect", "failure_cause", "case_study"],
+                },
+            },
+        },
+        "required": ["threads"],
+    },
+}
+
+FUSED_TOOL = {
+    "name": "emit_analyzed_threads",
+    "description": "Emit the separated email threads, each with its FMEA analysis.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "threads": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {name: {"type": "string"} for name in ("raw_text", "failure_mode", "failure_symptom", "failure_effect", "failure_cause", "case_study")},
+                    "required": ["raw_text", "failure_mode", "failure_symptom", "failure_effect", "failure_cause", "case_study"],
+                },
+            },
+        },
+        "required": ["threads"],
+    },
+}
+
+# The instructions go in the system message so every request shares the same cacheable prefix
+CONTENT_MESSAGE = Template("""Content to separate:
+$content
+""")
+
+ANALYSIS_INSTRUCTIONS = """
+    You are an experienced reliability engineer. Analyze the following email thread related to machinery defects, incidents, or troubles, and format the data under these headings:
+    - Failure Mode
+    - Failure Symptom
+    - Failure Effect
+    - Failure Cause
+
+    Use these FMEA (Failure Mode and Effects Analysis) definitions:
+
+    Failure Mode: A specific combination of a component and a verb that describes how the component fails to perform its intended function. It is the precise way in which an item or system's ability to perform its required function is lost or degraded. (Example: "Piston ring fractures")
+
+    Failure Symptom: An observable indicator that a failure mode is occurring or has occurred. (Example: "Increased vibration" or "Oil leakage")
+
+    Failure Effect: The resulting impact or consequence of a failure mode on the system's performance or operation. (Example: "Reduced engine power" or "Loss of hydraulic pressure")
+
+    Failure Cause: The underlying reason or mechanism that leads to the occurrence of a failure mode. (Example: "Wear and tear" or "Contaminated fuel")
+    Create a sort of detailed incident case study out of each thread. Also include timeline of events if it is available in mail threads. Extract as much meaningful data as possible from the email threads and put it in the case study.
+    """
+
+THREAD_MESSAGE = Template("""Email thread to analyze:
+$thread
+""")
+
+# Several threads analyzed in one request share a single copy of the instructions
+GROUPED_INSTRUCTIONS = ANALYSIS_INSTRUCTIONS + """
+    You will be given several email threads, each preceded by a line of the form "### THREAD <n> ###". Analyze each thread separately.
+    Respond only with a JSON object of the form {"threads": [{"failure_mode": "...", "failure_symptom": "...", "failure_effect": "...", "failure_cause": "...", "case_study": "..."}, ...]}
+    containing exactly one entry per thread, in the order the threads were given. Put the incident case study, including the timeline of events, in "case_study".
+    """
+
+# Separation and analysis in a single request: one round trip per window instead of one per thread
+FUSED_INSTRUCTIONS = ANALYSIS_INSTRUCTIONS + """
+    The content you will be given contains multiple email threads. First separate these threads; each thread should be returned complete, exactly as it appears in the content.
+    Use your intelligence to identify where one thread ends and another begins. Then analyze each thread separately.
+    Respond only with a JSON object of the form {"threads": [{"raw_text": "<full text of the thread>", "failure_mode": "...", "failure_symptom": "...", "failure_effect": "...", "failure_cause": "...", "case_study": "..."}, ...]}
+    containing one entry per thread, in the order the threads appear. Put the incident case study, including the timeline of events, in "case_study".
+    """
+
+FMEA_FIELDS = (
+    ("failure_mode", "Failure Mode"),
+    ("failure_symptom", "Failure Symptom"),
+    ("failure_effect", "Failure Effect"),
+    ("failure_cause", "Failure Cause"),
+    ("case_study", "Case Study"),
+)
+
+# The splitter echoes every thread back, so its windows are sized to the model's output limit.
+# Returns (window tokens, max_tokens).
+SEPARATION_CHUNK_OVERLAP = 200
+
+def separation_budget(model):
+    max_tokens = model_limits(model)[1]
+    return max_tokens * 5 // 8, max_tokens
+
+# Splitter output that is too short or has too little prose to be an email is not worth a paid analysis call
+MIN_THREAD_CHARS = 40
+MIN_THREAD_LETTERS = 20
+SHORT_THREAD_CHARS = 200
+EMAIL_HEADER_MARKERS = ("From:", "Subject:", "Sent:", "To:")
+
+def is_analyzable_thread(thread):
+    if len(thread) < MIN_THREAD_CHARS or sum(c.isalpha() for c in thread) < MIN_THREAD_LETTERS:
+        return False
+    # Short fragments are only kept when they look like an actual email
+    return len(thread) >= SHORT_THREAD_CHARS or any(marker in thread for marker in EMAIL_HEADER_MARKERS)
+
+# Items of the "threads" array that were emitted completely before a response was cut off at max_tokens
+def _complete_items(response):
+    decoder = json.JSONDecoder()
+    items = []
+    index = response.find("[") + 1
+    if index == 0:
+        return items
+    while True:
+        while index < len(response) and response[index] in " \t\r\n,":
+            index += 1
+        try:
+            item, index = decoder.raw_decode(response, index)
+        except json.JSONDecodeError:
+            return items
+        items.append(item)
+
+# The part of a window after the last thread the model emitted, or the whole window if that can't be located
+def _rest_of_window(chunk, last_thread):
+    end = chunk.find(last_thread.strip())
+    return chunk if end == -1 else chunk[end + len(last_thread.strip()):]
+
+# Returns (threads, rest), where rest is the part of the window the model didn't get to before its output
+# was cut off, or (None, "") if the response doesn't have the requested shape
+def _separate_chunk(chunk, model, params):
+    response = complete(SEPARATION_INSTRUCTIONS, CONTENT_MESSAGE.substitute(content=chunk), model, separation_budget(model)[1], params, {"type": "json_object"}, SEPARATION_TOOL)
+    rest = ""
+    try:
+        threads = json.loads(response)["threads"]
+    except json.JSONDecodeError:
+        # Truncated: keep the threads that were emitted completely
+        threads = [thread for thread in _complete_items(response) if isinstance(thread, str)]
+        rest = _rest_of_window(chunk, threads[-1]) if threads else chunk
+    except (KeyError, TypeError):
+        return None, ""
+    if not isinstance(threads, list):
+        return None, ""
+    threads = [thread.strip() for thread in threads if isinstance(thread, str)]
+    return [thread for thread in threads if is_analyzable_thread(thread)], rest
+
+# Separates every window, then whatever was left of truncated windows, keeping the threads in document order.
+# Returns the threads of each window and the number of windows that could not be (fully) separated.
+def _separate_windows(windows, model, params):
+    max_tokens = separation_budget(model)[1]
+    threads = [[] for _ in windows]
+    failed = 0
+    pending = list(enumerate(windows))
+    while pending:
+        results = run_concurrently(_separate_chunk, [window for _, window in pending], model, params, max_tokens=max_tokens)
+        remaining = []
+        for (index, window), (window_threads, rest) in zip(pending, results):
+            if window_threads is None:
+                failed += 1
+                continue
+            threads[index] += window_threads
+            if rest.strip():
+                # Only retry what is left when the model made progress, otherwise the window would loop forever
+                if len(rest) < len(window):
+                    remaining.append((index, rest))
+                else:
+                    failed += 1
+        pending = remaining
+    return threads, failed
+
+def separate_threads(content, model, params):
+    chunks = chunk_text(content, separation_budget(model)[0], SEPARATION_CHUNK_OVERLAP)
+    try:
+        results, failed = _separate_windows(chunks, model, params)
+    except BAD_REQUEST_ERRORS as e:
+        st.error(f"Error in API request: {str(e)}")
+        return []
+    if failed:
+        st.warning(f"{failed} part(s) of the document could not be separated into threads and were skipped.")
+    # Threads repeated in the overlap between windows are collapsed by deduplicate_threads
+    return [thread for threads in results for thread in threads]
+
+# Threads whose word 5-gram sets overlap at least this much are treated as the same thread
+NEAR_DUPLICATE_THRESHOLD = 0.9
+
+def _shingles(text, size=5):
+    words = text.lower().split()
+    return {" ".join(words[i:i + size]) for i in range(max(len(words) - size + 1, 1))}
+
+def _jaccard(a, b):
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+# Quoted replies make the splitter return the same thread several times; analyze each one only once.
+# Returns the unique threads and, for every input thread, the index of the unique thread standing in for it.
+def deduplicate_threads(threads):
+    unique = {}
+    keys = []
+    for thread in threads:
+        key = hashlib.blake2b(" ".join(thread.split()).encode("utf-8"), digest_size=16).hexdigest()
+        unique.setdefault(key, thread)
+        keys.append(key)
+
+    # Longest first, so the most complete version of a near-duplicate group is kept
+    kept = []
+    representative = {}
+    for key, thread in sorted(unique.items(), key=lambda item: len(item[1]), reverse=True):
+        shingles = _shingles(thread)
+        match = next((kept_key for kept_key, other in kept if _jaccard(shingles, other) >= NEAR_DUPLICATE_THRESHOLD), None)
+        if match is None:
+            kept.append((key, shingles))
+            match = key
+        representative[key] = match
+
+    # Unique threads keep the position where their group first appeared
+    order = list(dict.fromkeys(representative[key] for key in keys))
+    index = {key: i for i, key in enumerate(order)}
+    return [unique[key] for key in order], [index[representative[key]] for key in keys]
+
+def analyze_thread_stream(thread, model, params):
+    return stream_completion(ANALYSIS_INSTRUCTIONS, THREAD_MESSAGE.substitute(thread=thread), model, MAX_TOKENS, params, semantic=True)
+
+def analyze_thread(thread, model, params):
+    return "".join(analyze_thread_stream(thread, model, params))
+
+def stream_analyses(threads, model, params, on_text):
+    return stream_concurrently(analyze_thread_stream, threads, model, params, max_tokens=MAX_TOKENS, on_text=on_text)
+
+# Input budget for one grouped request; smaller models get what their context leaves after the output
+# and the instructions, and the output is capped by the model's limit
+GROUP_MAX_INPUT_TOKENS = 11000
+GROUP_PROMPT_RESERVE_TOKENS = 1500
+
+def group_budget(model, group_size):
+    context, output = model_limits(model)
+    max_tokens = min(MAX_TOKENS * group_size, output)
+    return min(GROUP_MAX_INPUT_TOKENS, context - max_tokens - GROUP_PROMPT_RESERVE_TOKENS), max_tokens
+
+def group_threads(threads, group_size, max_input_tokens):
+    encoding = get_encoding()
+    groups = []
+    current = []
+    current_tokens = 0
+    for thread in threads:
+        tokens = len(encoding.encode(thread))
+        if current and (len(current) == group_size or current_tokens + tokens > max_input_tokens):
+            groups.append(current)
+            current = []
+            current_tokens = 0
+        current.append(thread)
+        current_tokens += tokens
+    if current:
+        groups.append(current)
+    return groups
+
+def _format_fmea(item):
+    return "\n\n".join(f"**{label}:** {item.get(key) or 'Not stated in the thread.'}" for key, label in FMEA_FIELDS)
+
+def analyze_thread_group(group, model, params):
+    if len(group) == 1:
+        return [analyze_thread(group[0], model, params)]
+
+    message = "\n\n".join(f"### THREAD {i} ###\n{thread}" for i, thread in enumerate(group, 1))
+    response = complete(GROUPED_INSTRUCTIONS, message, model, min(MAX_TOKENS * len(group), model_limits(model)[1]), params, {"type": "json_object"}, GROUPED_TOOL)
+    try:
+        items = json.loads(response)["threads"]
+    except (json.JSONDecodeError, KeyError, TypeError):
+        items = None
+    if not isinstance(items, list) or len(items) != len(group) or not all(isinstance(item, dict) for item in items):
+        # Rather than risk attributing an analysis to the wrong thread, analyze_threads redoes the group one thread per request
+        return None
+    return [_format_fmea(item) for item in items]
+
+def analyze_threads(threads, model, params, group_size=1, on_result=None):
+    max_input_tokens, max_tokens = group_budget(model, group_size)
+    groups = group_threads(threads, group_size, max_input_tokens)
+    starts = [0]
+    for group in groups[:-1]:
+        starts.append(starts[-1] + len(group))
+
+    def on_group(index, analyses):
+        for offset, analysis in enumerate(analyses or []):
+            on_result(starts[index] + offset, analysis)
+
+    results = run_concurrently(analyze_thread_group, groups, model, params, max_tokens=max_tokens, on_result=on_group if on_result else None)
+    analyses = [analysis for group, group_analyses in zip(groups, results) for analysis in (group_analyses or [None] * len(group))]
+
+    # The fallback requests go through run_concurrently too, so they stay within the rate limits
+    failed = [i for i, analysis in enumerate(analyses) if analysis is None]
+    if failed:
+        on_retried = (lambda index, analysis: on_result(failed[index], analysis)) if on_result else None
+        retried = run_concurrently(analyze_thread, [threads[i] for i in failed], model, params, max_tokens=MAX_TOKENS, on_result=on_retried)
+        for i, analysis in zip(failed, retried):
+            analyses[i] = analysis
+    return analyses
+
+# The fused response echoes every thread and adds its analysis, so windows are smaller than for separation alone.
+# Returns (window tokens, max_tokens).
+def fused_budget(model):
+    max_tokens = model_limits(model)[1]
+    return max_tokens * 3 // 8, max_tokens
+
+# Returns (pairs, rest): the (thread, analysis) pairs of one window and the part of it the model didn't get to
+# before its output was cut off, or (None, "") if the response doesn't have the requested shape
+def _separate_and_analyze_chunk(chunk, model, params):
+    response = complete(FUSED_INSTRUCTIONS, CONTENT_MESSAGE.substitute(content=chunk), model, fused_budget(model)[1], params, {"type": "json_object"}, FUSED_TOOL)
+    rest = ""
+    try:
+        items = json.loads(response)["threads"]
+    except json.JSONDecodeError:
+        # Truncated: keep the threads that were emitted completely; the rest of the window is done in two passes
+        items = [item for item in _complete_items(response) if isinstance(item, dict) and isinstance(item.get("raw_text"), str)]
+        rest = _rest_of_window(chunk, items[-1]["raw_text"]) if items else chunk
+        if rest == chunk:
+            items = []
+    except (KeyError, TypeError):
+        return None, ""
+    if not isinstance(items, list):
+        return None, ""
+
+    pairs = [(item["raw_text"].strip(), _format_fmea(item)) for item in items if isinstance(item, dict) and isinstance(item.get("raw_text"), str)]
+    return [(thread, analysis) for thread, analysis in pairs if is_analyzable_thread(thread)], rest
+
+# Returns the threads and their analyses
+def separate_and_analyze(content, model, params):
+    chunk_tokens, max_tokens = fused_budget(model)
+    chunks = chunk_text(content, chunk_tokens, SEPARATION_CHUNK_OVERLAP)
+    try:
+        results = run_concurrently(_separate_and_analyze_chunk, chunks, model, params, max_tokens=max_tokens)
+        # Rests of truncated windows are separated and analyzed with regular, rate-limited requests
+        tails = [(index, rest) for index, (pairs, rest) in enumerate(results) if pairs is not None and rest.strip()]
+        tail_threads, failed = _separate_windows([rest for _, rest in tails], model, params)
+        flat_tail_threads = [thread for threads in tail_threads for thread in threads]
+        tail_analyses = run_concurrently(analyze_thread, flat_tail_threads, model, params, max_tokens=MAX_TOKENS)
+    except BAD_REQUEST_ERRORS as e:
+        st.error(f"Error in API request: {str(e)}")
+        return [], []
+
+    failed += sum(pairs is None for pairs, _ in results)
+    if failed:
+        st.warning(f"{failed} part(s) of the document could not be separated into threads and were skipped.")
+
+    # Each window's tail threads go right after the ones its own response covered
+    window_pairs = [pairs or [] for pairs, _ in results]
+    tail_pairs = iter(zip(flat_tail_threads, tail_analyses))
+    for (index, _), threads in zip(tails, tail_threads):
+        window_pairs[index] += [next(tail_pairs) for _ in threads]
+    pairs = [pair for pairs in window_pairs for pair in pairs]
+    return [thread for thread, _ in pairs], [analysis for _, analysis in pairs]
+
+# Submitted batches outlive the run that created them, so they are kept in the session state
+BATCH_STATE_KEY = "analysis_batch"
+
+# Only the unique threads are submitted; all threads are shown, each with its stand-in's analysis
+def submit_analysis_batch(threads, unique_threads, positions, model, params):
+    prompts = [THREAD_MESSAGE.substitute(thread=thread) for thread in unique_threads]
+    batch_id = submit_batch(ANALYSIS_INSTRUCTIONS, prompts, model, MAX_TOKENS, params)
+    st.session_state[BATCH_STATE_KEY] = {
+        "id": batch_id,
+        "model": model,
+        "params": params,
+        "threads": unique_threads,
+        "shown": threads,
+        "positions": positions,
+    }
+    return batch_id
+
+# Returns the analyses once the batch has finished, otherwise shows its status and returns None
+def fetch_analysis_batch():
+    batch = st.session_state[BATCH_STATE_KEY]
+    finished, analyses, status = fetch_batch(batch["id"], batch["model"], len(batch["threads"]))
+    if not finished:
+        st.info(status)
+        return None
+    if analyses is None:
+        st.error(status)
+        del st.session_state[BATCH_STATE_KEY]
+        return None
+
+    # Re-run only the requests that failed inside the batch, so completed ones aren't billed twice
+    failed = [i for i, analysis in enumerate(analyses) if analysis is None]
+    if failed:
+        with st.spinner(f"Retrying {len(failed)} failed batch requests..."):
+            retried = run_concurrently(analyze_thread, [batch["threads"][i] for i in failed], batch["model"], batch["params"], max_tokens=MAX_TOKENS)
+            for i, analysis in zip(failed, retried):
+                analyses[i] = analysis
+    return analyses
+
+# One slot per thread, so analyses that finish out of order still land under their thread
+def thread_slots(threads):
+    slots = []
+    for i, thread in enumerate(threads, 1):
+        st.subheader(f"Thread {i}")
+        with st.expander("Thread text", expanded=False):
+            st.text(thread)
+        st.write("FMEA Analysis:")
+        slots.append(st.empty())
+        st.markdown("---")
+    return slots
+
+# The last interactive run, shown again on reruns without a click until the document, model or settings change
+RESULTS_STATE_KEY = "multi_thread_analysis"
+
+def main():
+    st.title("Multi-Thread FMEA Analyzer")
+
+    content, params, model = render_inputs("Choose a DOCX file", "File contents", OPENAI_MODEL)
+
+    if content is not None:
+        batch_mode = st.sidebar.checkbox("Offline batch (half price, results within 24h)")
+        fused = not batch_mode and st.sidebar.checkbox("Separate and analyze in one request", help="One request per part of the document instead of one per thread; analyses are not streamed")
+        group_size = 1 if batch_mode or fused else st.sidebar.slider("Threads per request", 1, 10, 1, help="Analyze several short threads in one request to save on repeated instructions")
+
+        key = analysis_key(content, model, params, batch_mode, fused, group_size)
+        analyze = st.button("Analyze")
+        results = st.session_state.get(RESULTS_STATE_KEY)
+        # Analyze always runs again, so failed runs can be retried and sampled answers redrawn
+        if analyze:
+            if fused:
+                with st.spinner("Separating and analyzing threads..."):
+                    threads, fused_analyses = separate_and_analyze(content, model, params)
+            else:
+                with st.spinner("Separating threads..."):
+                    threads = separate_threads(content, model, params)
+
+            unique_threads, positions = deduplicate_threads(threads)
+            if len(unique_threads) < len(threads):
+                summary = f"Found {len(threads)} threads ({len(threads) - len(unique_threads)} duplicates analyzed only once)."
+            else:
+                summary = f"Found {len(threads)} threads."
+            st.write(summary)
+
+            if batch_mode:
+                with st.spinner("Submitting batch..."):
+                    batch_id = submit_analysis_batch(threads, unique_threads, positions, model, params)
+                st.info(f"Batch {batch_id} submitted. Use \"Fetch batch results\" to collect the analyses once it has finished.")
+            else:
+                # Every unique analysis is shown under each thread it stands in for
+                copies = [[] for _ in unique_threads]
+                for slot, position in zip(thread_slots(threads), positions):
+                    copies[position].append(slot)
+
+                def show(i, text):
+                    for slot in copies[i]:
+                        slot.markdown(text)
+
+                if fused:
+                    analysis_by_thread = dict(zip(threads, fused_analyses))
+                    analyses = [analysis_by_thread[thread] for thread in unique_threads]
+                    for i, analysis in enumerate(analyses):
+                        show(i, analysis)
+                elif group_size == 1:
+                    analyses = stream_analyses(unique_threads, model, params, on_text=show)
+                else:
+                    with st.spinner(f"Analyzing {len(unique_threads)} threads..."):
+                        analyses = analyze_threads(unique_threads, model, params, group_size, on_result=show)
+                analyses = [analyses[position] for position in positions]
+                # A run that found no threads (e.g. the splitter failed) is not worth showing again
+                if threads:
+                    st.session_state[RESULTS_STATE_KEY] = {"key": key, "summary": summary, "threads": threads, "analyses": analyses}
+        elif results is not None and results["key"] == key:
+            st.write(results["summary"])
+            for slot, analysis in zip(thread_slots(results["threads"]), results["analyses"]):
+                slot.write(analysis)
+
+    # Available without re-uploading the file, for as long as the session lasts
+    if BATCH_STATE_KEY in st.session_state and st.button("Fetch batch results"):
+        with st.spinner("Checking batch..."):
+            analyses = fetch_analysis_batch()
+        if analyses is not None:
+            batch = st.session_state[BATCH_STATE_KEY]
+            for slot, position in zip(thread_slots(batch["shown"]), batch["positions"]):
+                slot.write(analyses[position])
+
+if __name__ == "__main__":
+    main()
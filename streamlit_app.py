@@ -1,43 +1,13 @@
+from string import Template
 import streamlit as st
-import docx
-import openai
-import anthropic
-import os
-from dotenv import load_dotenv
-
-# Load environment variables
-load_dotenv()
-
-# Initialize API keys
-def get_openai_api_key():
-    if 'openai' in st.secrets:
-        return st.secrets['openai']['api_key']
-    api_key = os.getenv('OPENAI_API_KEY')
-    if api_key is None:
-        raise ValueError("OpenAI API key not found. Set OPENAI_API_KEY as an environment variable or in Streamlit secrets.")
-    return api_key
-
-def get_anthropic_api_key():
-    if 'anthropic' in st.secrets:
-        return st.secrets['anthropic']['api_key']
-    api_key = os.getenv('ANTHROPIC_API_KEY')
-    if api_key is None:
-        raise ValueError("Anthropic API key not found. Set ANTHROPIC_API_KEY as an environment variable or in Streamlit secrets.")
-    return api_key
-
-# Set up clients
-openai.api_key = get_openai_api_key()
-anthropic_client = anthropic.Anthropic(api_key=get_anthropic_api_key())
-
-def read_docx(file):
-    doc = docx.Document(file)
-    full_text = []
-    for para in doc.paragraphs:
-        full_text.append(para.text)
-    return "\n".join(full_text)
-
-def analyze_thread(thread, model, temperature=0.7, top_p=1.0, frequency_penalty=0.0, presence_penalty=0.0):
-    prompt = f"""
+from llm import model_limits, stream_completion, run_concurrently, chunk_text, get_encoding
+from ui import render_inputs, analysis_key
+
+# The detailed FMECA case study is worth the larger model
+OPENAI_MODEL = "gpt-4"
+MAX_TOKENS = 2000
+
+ANALYSIS_INSTRUCTIONS = """
     # Prompt for FMECA and Incident Case Study Generation
 
 You are an experienced reliability engineer tasked with generating a comprehensive FMECA (Failure Modes, Effects, and Criticality Analysis) and an accompanying incident case study for a marine vessel that experienced a specific failure mode. Your analysis should be based solely on the facts provided in the given data, without introducing any external information or assumptions.
@@ -132,65 +102,91 @@ d) Lessons Learned:
 6. If any required information is missing from the provided data, indicate this in your analysis rather than making assumptions.
 
 Remember, as an experienced reliability engineer, your goal is to present a comprehensive understanding of the incident, its causes, effects, and the actions taken to address it, based strictly on the available information. Use your expertise to accurately categorize and analyze the failure according to the FMEA definitions provided.
-    Email thread to analyze:
-    {thread}
-    """
-
-    if model == "OpenAI":
-        response = openai.ChatCompletion.create(
-            model="gpt-4",
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=1000,
-            temperature=temperature,
-            top_p=top_p,
-            frequency_penalty=frequency_penalty,
-            presence_penalty=presence_penalty
-        )
-        return response.choices[0].message.content
-    elif model == "Claude":
-        response = anthropic_client.completions.create(
-            prompt=f"{anthropic.HUMAN_PROMPT} {prompt}{anthropic.AI_PROMPT}",
-            model="claude-2",
-            max_tokens_to_sample=1000,
-            temperature=temperature,
-            top_p=top_p,
-        )
-        return response.completion
+"""
+
+# The instructions go in the system message so every request shares the same cacheable prefix
+THREAD_MESSAGE = Template("""Email thread to analyze:
+$thread
+""")
+
+# Threads that don't fit into the model's context are analyzed in overlapping parts whose analyses are then merged
+ANALYSIS_CHUNK_OVERLAP = 200
+
+# Room kept free in the context for the instructions; the output gets MAX_TOKENS and the thread or partial analyses the rest
+PROMPT_RESERVE_TOKENS = 2000
+
+def input_budget(model):
+    return model_limits(model)[0] - MAX_TOKENS - PROMPT_RESERVE_TOKENS
+
+MERGE_INSTRUCTIONS = ANALYSIS_INSTRUCTIONS + """
+The email thread was too long to analyze in one pass, so it was split into consecutive, slightly overlapping parts and each part was analyzed separately using the instructions above.
+You are given those partial analyses in order. Merge them into a single analysis of the whole thread under the same headings, removing repetition and reconciling the timeline across parts.
+"""
+
+PARTIAL_ANALYSES_MESSAGE = Template("""Partial analyses to merge:
+$analyses
+""")
+
+def _analyze_part(part, model, params):
+    return "".join(stream_completion(ANALYSIS_INSTRUCTIONS, THREAD_MESSAGE.substitute(thread=part), model, MAX_TOKENS, params))
+
+def _merge_message(partials):
+    analyses = "\n\n".join(f"--- Part {i} of {len(partials)} ---\n{partial}" for i, partial in enumerate(partials, 1))
+    return PARTIAL_ANALYSES_MESSAGE.substitute(analyses=analyses)
+
+def _merge_group(partials, model, params):
+    return "".join(stream_completion(MERGE_INSTRUCTIONS, _merge_message(partials), model, MAX_TOKENS, params))
+
+def _pack_partials(partials, budget):
+    encoding = get_encoding()
+    groups = [[]]
+    group_tokens = 0
+    for partial in partials:
+        tokens = len(encoding.encode(partial))
+        if groups[-1] and group_tokens + tokens > budget:
+            groups.append([])
+            group_tokens = 0
+        groups[-1].append(partial)
+        group_tokens += tokens
+    return groups
+
+def analyze_thread_stream(thread, model, params):
+    budget = input_budget(model)
+    parts = chunk_text(thread, budget, ANALYSIS_CHUNK_OVERLAP)
+    if len(parts) == 1:
+        return stream_completion(ANALYSIS_INSTRUCTIONS, THREAD_MESSAGE.substitute(thread=thread), model, MAX_TOKENS, params, semantic=True)
+
+    # Map: analyze all parts concurrently
+    partials = run_concurrently(_analyze_part, parts, model, params, max_tokens=MAX_TOKENS)
+    # Reduce: merge in rounds while the partial analyses don't fit into one request, then stream the final merge
+    groups = _pack_partials(partials, budget)
+    while len(groups) > 1:
+        groups = _pack_partials(run_concurrently(_merge_group, groups, model, params, max_tokens=MAX_TOKENS), budget)
+    return stream_completion(MERGE_INSTRUCTIONS, _merge_message(groups[0]), model, MAX_TOKENS, params)
+
+# The last analysis, shown again on reruns without a click until the document, model or parameters change
+RESULT_STATE_KEY = "single_thread_analysis"
 
 def main():
     st.title("Single Email Thread FMEA Analyzer")
 
-    # Add model selection
-    model = st.sidebar.selectbox("Select Model", ["OpenAI", "Claude"])
-
-    uploaded_file = st.file_uploader("Choose a DOCX file containing a single email thread", type="docx")
-
-    if uploaded_file is not None:
-        content = read_docx(uploaded_file)
-        st.write("Email thread content:")
-        st.write(content)
-
-        # Add sliders for LLM parameters
-        st.sidebar.header("LLM Parameters")
-        temperature = st.sidebar.slider("Temperature", 0.0, 1.0, 0.7, 0.1)
-        top_p = st.sidebar.slider("Top P", 0.0, 1.0, 1.0, 0.1)
-        
-        # Note: Claude API doesn't use frequency_penalty and presence_penalty
-        if model == "OpenAI":
-            frequency_penalty = st.sidebar.slider("Frequency Penalty", 0.0, 2.0, 0.0, 0.1)
-            presence_penalty = st.sidebar.slider("Presence Penalty", 0.0, 2.0, 0.0, 0.1)
-        else:
-            frequency_penalty = 0.0
-            presence_penalty = 0.0
-
-        if st.button("Analyze"):
+    content, params, model = render_inputs("Choose a DOCX file containing a single email thread", "Email thread content", OPENAI_MODEL)
+
+    if content is not None:
+        key = analysis_key(content, model, params)
+        analyze = st.button("Analyze")
+        result = st.session_state.get(RESULT_STATE_KEY)
+        # Analyze always runs again, so a sampled (temperature > 0) answer can be redrawn
+        if analyze:
             with st.spinner("Analyzing email thread..."):
-                analysis = analyze_thread(content, model, temperature, top_p, frequency_penalty, presence_penalty)
-                st.subheader("FMEA Analysis:")
-                st.write(analysis)
+                analysis = analyze_thread_stream(content, model, params)
+            st.subheader("FMEA Analysis:")
+            analysis = st.write_stream(analysis)
+            if analysis:
+                st.session_state[RESULT_STATE_KEY] = {"key": key, "analysis": analysis}
+        elif result is not None and result["key"] == key:
+            st.subheader("FMEA Analysis:")
+            st.write(result["analysis"])
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,100 @@
+import hashlib
+import io
+import zipfile
+import xml.etree.ElementTree as ET
+import streamlit as st
+from llm import CLAUDE_MODEL, OPENAI_MODELS, default_openai_model, REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE
+
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+# Streams paragraph text straight out of word/document.xml instead of building the full python-docx object model
+def _iter_docx_paragraphs(data):
+    with zipfile.ZipFile(io.BytesIO(data)) as archive, archive.open("word/document.xml") as document:
+        paragraphs = []
+        in_properties = 0
+        depth = 0
+        body = None
+        for event, element in ET.iterparse(document, events=("start", "end")):
+            tag = element.tag
+            depth += 1 if event == "start" else -1
+            if tag == _W + "body":
+                body = element
+            elif tag == _W + "p":
+                if event == "start":
+                    paragraphs.append([])
+                else:
+                    yield "".join(paragraphs.pop())
+            elif tag == _W + "pPr":
+                # Tab stops are declared as <w:tab> inside the paragraph properties
+                in_properties += 1 if event == "start" else -1
+            elif event == "end" and paragraphs and not in_properties:
+                if tag == _W + "t":
+                    paragraphs[-1].append(element.text or "")
+                elif tag == _W + "tab":
+                    paragraphs[-1].append("\t")
+                elif tag in (_W + "br", _W + "cr"):
+                    paragraphs[-1].append("\n")
+
+            # Detach each finished top-level block (paragraph, table, ...) so memory stays flat however long the document is
+            if event == "end" and depth == 2 and body is not None:
+                body.clear()
+
+# The spinner is only shown on a cache miss, i.e. while a newly uploaded file is parsed
+@st.cache_data(show_spinner="Reading document...")
+def read_docx(data):
+    return "\n".join(_iter_docx_paragraphs(data))
+
+# Model selection, DOCX upload and LLM parameter sliders shared by every page.
+# Returns (content, params, model); content and params are None until a file is uploaded.
+def render_inputs(uploader_label, content_label, openai_model):
+    # Add model selection
+    model_choice = st.sidebar.selectbox("Select Model", ["OpenAI", "Claude"])
+    if model_choice == "OpenAI":
+        model = st.sidebar.selectbox("OpenAI Model", list(dict.fromkeys((default_openai_model(openai_model),) + OPENAI_MODELS)))
+    else:
+        model = CLAUDE_MODEL
+
+    uploaded_file = st.file_uploader(uploader_label, type="docx")
+    if uploaded_file is None:
+        return None, None, model
+
+    content = read_docx(uploaded_file.getvalue())
+    # Collapsed by default so a large document isn't re-rendered on every slider change; st.text skips Markdown parsing
+    with st.expander(content_label, expanded=False):
+        st.text(content)
+
+    # Add sliders for LLM parameters
+    st.sidebar.header("LLM Parameters")
+    temperature = st.sidebar.slider("Temperature", 0.0, 1.0, 0.7, 0.1)
+    top_p = st.sidebar.slider("Top P", 0.0, 1.0, 1.0, 0.1)
+
+    # Note: Claude API doesn't use frequency_penalty and presence_penalty
+    if model_choice == "OpenAI":
+        frequency_penalty = st.sidebar.slider("Frequency Penalty", 0.0, 2.0, 0.0, 0.1)
+        presence_penalty = st.sidebar.slider("Presence Penalty", 0.0, 2.0, 0.0, 0.1)
+    else:
+        frequency_penalty = 0.0
+        presence_penalty = 0.0
+
+    st.sidebar.header("Caching")
+    semantic_cache = st.sidebar.checkbox("Reuse answers for near-identical threads", help="Matches earlier threads by embedding similarity. Requires an OpenAI API key, also when analyzing with Claude.")
+    semantic_threshold = st.sidebar.slider("Similarity threshold", 0.80, 1.00, 0.92, 0.01, disabled=not semantic_cache)
+
+    # Read by llm.run_concurrently through the session state; higher API tiers have 10-100x higher limits
+    st.sidebar.header("Rate Limits")
+    st.sidebar.number_input("Requests per minute", 1, 100000, REQUESTS_PER_MINUTE, 100, key="requests_per_minute")
+    st.sidebar.number_input("Tokens per minute", 1000, 100000000, TOKENS_PER_MINUTE, 10000, key="tokens_per_minute")
+
+    params = {
+        "temperature": temperature,
+        "top_p": top_p,
+        "frequency_penalty": frequency_penalty,
+        "presence_penalty": presence_penalty,
+        "semantic_threshold": semantic_threshold if semantic_cache else None,
+    }
+    return content, params, model
+
+# Identifies an analysis run, so results kept in the session state are only reused for the same
+# document, model and parameters instead of being recomputed on every widget change
+def analysis_key(content, model, params, *options):
+    return hashlib.sha256(repr((content, model, sorted(params.items()), options)).encode("utf-8")).hexdigest()